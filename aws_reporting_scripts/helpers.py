@@ -6,10 +6,38 @@
 
 """Common functions for aws-reporting-scripts"""
 
+import csv
+import io
+import os
 import sys
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import lru_cache
 import boto3
+import botocore.config
 import botocore.exceptions
 
+# Upper bound on concurrent per-region workers, and the HTTP connection pool to match
+MAX_WORKERS = 32
+
+# Shared config for clients used concurrently from worker threads; keepalive lets pooled
+# connections be reused across pages and follow-up calls
+CLIENT_CONFIG = botocore.config.Config(max_pool_connections=MAX_WORKERS,
+                                       retries={'mode': 'adaptive', 'max_attempts': 10},
+                                       tcp_keepalive=True)
+
+# Write buffer for non-interactive stdout (e.g. redirected to a file or pipe)
+STDOUT_BUFFER_SIZE = 1 << 20
+
+# Characters stripped from TSV fields, so field values cannot break columns or rows
+_TSV_STRIP = str.maketrans('', '', '\t\r\n')
+
+# Single session shared by all clients; boto3 sessions are not thread-safe, so client
+# creation from worker threads is serialised
+_SESSION = boto3.session.Session()
+_CLIENT_LOCK = threading.Lock()
+
 def get_region(proposed_region):
     """Check if passed region is valid/available, or use user's default region.
 
@@ -24,16 +52,99 @@ def get_region(proposed_region):
     else:
         # If proposed region is False, try to establish the user's default region
         try:
-            session = boto3.session.Session()
-            region = session.region_name
+            region = _SESSION.region_name
         except:
             raise Exception('Could not establish region. Specify -r or configure AWS_CREDENTIALS')
     return region
 
+@lru_cache(maxsize=None)
+def get_client(service, region=None):
+    """Return client for service in region, cached per (service, region)."""
+    with _CLIENT_LOCK:
+        return _SESSION.client(service, region_name=region, config=CLIENT_CONFIG)
+
+@lru_cache(maxsize=None)
+def get_account_id():
+    """Return AWS account number.
+
+    Use AWS_ACCOUNT_ID from the environment if set, otherwise query STS (once per process)."""
+    return os.environ.get('AWS_ACCOUNT_ID') or get_client('sts').get_caller_identity()['Account']
+
+@contextmanager
+def open_stdout():
+    """Yield text stream over stdout suitable for csv.writer.
+
+    Line-buffered when stdout is a terminal; otherwise block-buffered with STDOUT_BUFFER_SIZE.
+    The stream is flushed on exit, leaving the stdout file descriptor open."""
+    sys.stdout.flush()
+    with open(sys.stdout.fileno(), 'wb', buffering=STDOUT_BUFFER_SIZE,
+              closefd=False) as stdout_bytes:
+        with io.TextIOWrapper(stdout_bytes, encoding='utf-8', newline='',
+                              line_buffering=sys.stdout.isatty()) as stdout:
+            yield stdout
+
+class TsvWriter:
+    """Tab-separated writer with the csv.writer writerow()/writerows() interface.
+
+    Fields are not quoted; tabs and newlines are stripped from field values."""
+    def __init__(self, stream):
+        self._write = stream.write
+
+    def writerow(self, row):
+        """Write row to stream."""
+        self._write(_tsv_line(row))
+
+    def writerows(self, rows):
+        """Write all rows to stream in a single write."""
+        self._write(''.join([_tsv_line(row) for row in rows]))
+
+def _tsv_line(row):
+    """Return row as a newline-terminated, tab-separated line."""
+    return '\t'.join([str(field).translate(_TSV_STRIP) for field in row]) + '\n'
+
+def get_writer(stream, output_format):
+    """Return writer for stream; output_format is 'csv' or 'tsv'."""
+    if output_format == 'tsv':
+        return TsvWriter(stream)
+    return csv.writer(stream, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+
+def write_region_rows(header, process_region, region_list, account_number, output_format):
+    """Write header, then rows of process_region(region, account_number) for each region, to stdout.
+
+    Regions are queried concurrently; rows are written from the calling thread only, as each
+    region completes."""
+    with open_stdout() as stdout:
+        output = get_writer(stdout, output_format)
+        output.writerow(header)
+        # The pool only starts threads as work is submitted. No reference to the futures is
+        # kept outside as_completed(), which drops each one as it is yielded, so each region's
+        # rows are freed once written
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            for future in as_completed([executor.submit(process_region, region, account_number)
+                                        for region in region_list]):
+                output.writerows(future.result())
+
+def get_cached(cache, key, function, *args):
+    """Return function(*args), memoised in cache dict under key.
+
+    The first caller for a key stores a Future and makes the call; concurrent callers for the
+    same key wait on that Future rather than repeating the call."""
+    future = Future()
+    cached = cache.setdefault(key, future)
+    if cached is not future:
+        return cached.result()
+    try:
+        future.set_result(function(*args))
+    except Exception as err:
+        future.set_exception(err)
+        raise
+    return future.result()
+
 def get_items(client, function, item_name, **args):
     """Generic paginator.
 
     Yield items in client.function(args)['item_name']
+    Pages are fetched lazily, as items are consumed
     """
     # Used because botocore is still missing many documented paginators
     # See: https://github.com/boto/botocore/issues/1462
@@ -49,13 +160,15 @@ def get_items(client, function, item_name, **args):
 
 def get_region_list():
     """Return list of AWS regions."""
+    # Only region names are needed; describe_regions returns them in a single call
+    # (Session.get_available_regions() would also list regions not enabled for this account)
     try:
-        ec2_client = boto3.client('ec2')
+        ec2_client = get_client('ec2')
     except botocore.exceptions.NoRegionError:
         # If we fail because the user has no default region, use us-east-1
         # This is for listing regions only
         # Iterating resources is then performed in each region
-        ec2_client = boto3.client('ec2', region_name='us-east-1')
+        ec2_client = get_client('ec2', 'us-east-1')
     try:
         region_list = ec2_client.describe_regions()['Regions']
     except botocore.exceptions.ClientError as err:
@@ -6,68 +6,86 @@
 
 """List EC2 instances, SSM agent and platform details as CSV."""
 
-import sys
 import argparse
-import csv
-import boto3
+import types
+from concurrent.futures import ThreadPoolExecutor
 import helpers
 
+HEADER = ('Account', 'Region', 'InstanceID', 'Name', 'EC2Platform', 'SSMPingStatus',
+          'SSMAgentVersion', 'SSMPlatformType', 'SSMPlatformName', 'SSMPlatformVersion')
+
+# Shared, read-only SSM agent details for instances not managed by SSM
+_EMPTY_SSM_INFO = types.MappingProxyType({'ping_status': '',
+                                          'agent_version': '',
+                                          'platform_type': '',
+                                          'platform_name': '',
+                                          'platform_version': ''})
+
 def main():
-    """Gather and write CSV data, one row per Instance.
+    """Gather and write CSV (or TSV) data, one row per Instance.
 
     Iterate through specified AWS regions
     Iterate through all EC2 instances
+    Query SSM agent version, status, platform information for all instances in region
     Query basic EC2 instance information (Name tag, EC2 platform)
-    Query SSM agent version, status, platform information
     """
     args = parse_args()
     if args.region == 'all' or args.region == 'ALL':
+        # Resolve regions before any output, so region lookup errors leave stdout empty
         region_list = list(helpers.get_region_list())
     else:
         # Check valid or return default region
         region_list = [helpers.get_region(args.region)]
 
-    output = csv.writer(sys.stdout, delimiter=',', quotechar='"',
-                        quoting=csv.QUOTE_ALL)
-
-    # Get AWS account number from STS
-    account_number = boto3.client('sts').get_caller_identity()['Account']
-
-    # Header row
-    output.writerow(['Account', 'Region', 'InstanceID', 'Name', 'EC2Platform', 'SSMPingStatus',
-                     'SSMAgentVersion', 'SSMPlatformType', 'SSMPlatformName',
-                     'SSMPlatformVersion'])
-
-    for region in region_list:
-        ec2_client = boto3.client('ec2', region_name=region)
-        ssm_client = boto3.client('ssm', region_name=region)
-        instance_state_filter = {
-            'Name': 'instance-state-name',
-            'Values': [
-                #'pending',
-                'running',
-                #'shutting-down',
-                #'terminated',
-                'stopping',
-                'stopped',
-            ]
-        }
-        for reservation in helpers.get_items(client=ec2_client,
-                                             function='describe_instances',
-                                             item_name='Reservations',
-                                             Filters=[instance_state_filter]):
-            for instance in reservation['Instances']:
-                instance_ssm_info = get_instance_ssm_info(ssm_client, instance['InstanceId'])
-                output.writerow([account_number,
-                                 region,
-                                 instance['InstanceId'],
-                                 get_instance_name(instance),
-                                 get_instance_platform(instance),
-                                 instance_ssm_info['ping_status'],
-                                 instance_ssm_info['agent_version'],
-                                 instance_ssm_info['platform_type'],
-                                 instance_ssm_info['platform_name'],
-                                 instance_ssm_info['platform_version']])
+    # Get AWS account number from environment or STS
+    account_number = helpers.get_account_id()
+
+    helpers.write_region_rows(HEADER, process_region, region_list, account_number, args.format)
+
+def process_region(region, account_number):
+    """Return list of CSV rows, one per Instance in region."""
+    rows = []
+    ec2_client = helpers.get_client('ec2', region)
+    ssm_client = helpers.get_client('ssm', region)
+    instance_state_filter = {
+        'Name': 'instance-state-name',
+        'Values': [
+            #'pending',
+            'running',
+            #'shutting-down',
+            #'terminated',
+            'stopping',
+            'stopped',
+        ]
+    }
+    # Page through SSM instance information while EC2 instances are listed
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        ssm_info_future = executor.submit(build_ssm_info_map, ssm_client)
+        # Keep only the fields needed for output as each page arrives, rather than whole
+        # instance descriptions
+        instances = [(instance['InstanceId'],
+                      get_instance_name(instance),
+                      get_instance_platform(instance))
+                     for reservation in helpers.get_items(client=ec2_client,
+                                                          function='describe_instances',
+                                                          item_name='Reservations',
+                                                          Filters=[instance_state_filter],
+                                                          MaxResults=1000)
+                     for instance in reservation['Instances']]
+        ssm_info_map = ssm_info_future.result()
+    for instance_id, instance_name, instance_platform in instances:
+        instance_ssm_info = get_instance_ssm_info(ssm_info_map, instance_id)
+        rows.append((account_number,
+                     region,
+                     instance_id,
+                     instance_name,
+                     instance_platform,
+                     instance_ssm_info['ping_status'],
+                     instance_ssm_info['agent_version'],
+                     instance_ssm_info['platform_type'],
+                     instance_ssm_info['platform_name'],
+                     instance_ssm_info['platform_version']))
+    return rows
 
 def parse_args():
     """Create arguments and populate variables from args.
@@ -76,47 +94,42 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('-r', '--region', type=str, default=False,
                         help='AWS region; Use "all" for all regions')
+    parser.add_argument('-f', '--format', type=str, choices=['csv', 'tsv'], default='csv',
+                        help='Output format')
     return parser.parse_args()
 
 def get_instance_name(instance):
     """Return instance 'Name' tag value if it exists."""
-    instance_name = ''
-    try:
-        # Looping through tags seems ugly, but no better way in boto3
-        # See https://github.com/boto/boto3/issues/264
-        for tag in instance['Tags']:
-            if tag['Key'] == 'Name':
-                instance_name = tag['Value']
-    except KeyError:
-        pass    # Instance has no tags at all
-    return instance_name
+    # Index tags by key rather than scanning the list for each lookup
+    # See https://github.com/boto/boto3/issues/264
+    tags = {tag['Key']: tag.get('Value', '') for tag in instance.get('Tags', [])}
+    return tags.get('Name', '')
 
 def get_instance_platform(instance):
     """Return instance Platform value if it exists."""
-    instance_platform = ''
-    try:
-        instance_platform = instance['Platform']
-    except KeyError:
-        pass
-    return instance_platform
-
-def get_instance_ssm_info(ssm_client, instance_id):
+    return instance.get('Platform', '')
+
+def build_ssm_info_map(ssm_client):
+    """Return SSM agent details for all managed instances, keyed by InstanceId."""
+    # One paginated query per region, rather than one query per EC2 instance
+    # Hybrid (on-premises) managed instances can never match an EC2 instance; filter them out
+    resource_type_filter = {'Key': 'ResourceType', 'Values': ['EC2Instance']}
+    # Keep only the fields needed for output as each page arrives, rather than whole
+    # instance information
+    return {item['InstanceId']: {'ping_status': item['PingStatus'],
+                                 'agent_version': item['AgentVersion'],
+                                 'platform_type': item['PlatformType'],
+                                 'platform_name': item['PlatformName'],
+                                 'platform_version': item['PlatformVersion']}
+            for item in helpers.get_items(client=ssm_client,
+                                          function='describe_instance_information',
+                                          item_name='InstanceInformationList',
+                                          Filters=[resource_type_filter],
+                                          MaxResults=50)}
+
+def get_instance_ssm_info(ssm_info_map, instance_id):
     """Return SSM agent details."""
-    ping_status, agent_version, platform_type, platform_name, platform_version = '', '', '', '', ''
-    filters = {'key': 'InstanceIds', 'valueSet': [instance_id]}
-    ssm_information = (ssm_client.describe_instance_information
-                       (InstanceInformationFilterList=[filters])['InstanceInformationList'])
-    if ssm_information:
-        ping_status = ssm_information[0]['PingStatus']
-        agent_version = ssm_information[0]['AgentVersion']
-        platform_type = ssm_information[0]['PlatformType']
-        platform_name = ssm_information[0]['PlatformName']
-        platform_version = ssm_information[0]['PlatformVersion']
-    return {'ping_status': ping_status,
-            'agent_version': agent_version,
-            'platform_type': platform_type,
-            'platform_name': platform_name,
-            'platform_version': platform_version}
+    return ssm_info_map.get(instance_id, _EMPTY_SSM_INFO)
 
 if __name__ == '__main__':
     main()
@@ -21,14 +21,19 @@ List SSM Maintenance Windows, Tasks and Patching Baseline details.
     - Approval Delay
 """
 
-import sys
 import argparse
-import csv
-import boto3
+from concurrent.futures import ThreadPoolExecutor
 import helpers
 
+# Concurrent Maintenance Windows queried per region
+MW_WORKERS = 8
+
+HEADER = ('Account', 'Region', 'MW ID', 'MW Name', 'MW Schedule', 'MW TZ', 'Task 1 ID',
+          'Patch Group', 'Task', 'Operation', 'Baseline', 'Baseline Name', 'OS',
+          'Patch Filter (MSRC Sev)', 'Patch Filter (Class)', 'Approval Delay')
+
 def main():
-    """Gather and write CSV data, one row per Maintenance Window.
+    """Gather and write CSV (or TSV) data, one row per Maintenance Window.
 
     Iterate through specified AWS regions
     Iterate through all SSM Maintenance Windows
@@ -37,56 +42,56 @@ def main():
     """
     args = parse_args()
     if args.region == 'all' or args.region == 'ALL':
+        # Resolve regions before any output, so region lookup errors leave stdout empty
         region_list = list(helpers.get_region_list())
     else:
         # Check valid or return default region
         region_list = [helpers.get_region(args.region)]
 
-    output = csv.writer(sys.stdout, delimiter=',', quotechar='"',
-                        quoting=csv.QUOTE_ALL)
-
-    # Header row
-    output.writerow(['Account', 'Region', 'MW ID', 'MW Name', 'MW Schedule', 'MW TZ', 'Task 1 ID',
-                     'Patch Group', 'Task', 'Operation', 'Baseline', 'Baseline Name', 'OS',
-                     'Patch Filter (MSRC Sev)', 'Patch Filter (Class)', 'Approval Delay'])
-
-    # Get AWS account number from STS
-    account_number = boto3.client('sts').get_caller_identity()['Account']
-
-    # Iterate through regions and Maintenance Windows
-    for region in region_list:
-        ssm_client = boto3.client('ssm', region_name=region)
-        mw_enabled_filter = {'Key':'Enabled', 'Values':['true']}
-        for maint_window in helpers.get_items(client=ssm_client,
-                                              function='describe_maintenance_windows',
-                                              item_name='WindowIdentities',
-                                              Filters=[mw_enabled_filter]):
-            # Gather data
-            maint_window_info = get_maint_window_info(ssm_client, maint_window['WindowId'])
-            task_1_id = get_maint_window_task_1(ssm_client, maint_window['WindowId'])
-            task_info = get_task_info(ssm_client, maint_window['WindowId'], task_1_id)
-            patch_tag = get_target_patch_tag(ssm_client, maint_window['WindowId'],
-                                             task_info['target_id'])
-            baseline_id = get_baseline_id(ssm_client, patch_tag)
-            baseline_info = get_baseline_info(ssm_client, baseline_id)
-
-            # Output data
-            output.writerow([account_number,
-                             region,
-                             maint_window['WindowId'],
-                             maint_window_info['name'],
-                             maint_window_info['sched'],
-                             maint_window_info['time_zone'],
-                             task_1_id,
-                             patch_tag,
-                             task_info['task'],
-                             task_info['operation'],
-                             baseline_id,
-                             baseline_info['name'],
-                             baseline_info['operating_system'],
-                             baseline_info['filter_msrc_sev'],
-                             baseline_info['filter_class'],
-                             baseline_info['delay']])
+    # Get AWS account number from environment or STS
+    account_number = helpers.get_account_id()
+
+    helpers.write_region_rows(HEADER, process_region, region_list, account_number, args.format)
+
+def process_region(region, account_number):
+    """Return list of CSV rows, one per Maintenance Window in region."""
+    rows = []
+    ssm_client = helpers.get_client('ssm', region)
+    mw_enabled_filter = {'Key':'Enabled', 'Values':['true']}
+    # Patch Baselines are commonly shared between Maintenance Windows; memoise per region
+    baseline_caches = {'baseline_id': {}, 'baseline_info': {}}
+    # Query Task -> Target -> Patch Baseline chain of Maintenance Windows concurrently
+    with ThreadPoolExecutor(max_workers=MW_WORKERS) as executor:
+        futures = [(maint_window,
+                    executor.submit(get_patching_info, ssm_client, maint_window['WindowId'],
+                                    baseline_caches))
+                   for maint_window in helpers.get_items(client=ssm_client,
+                                                         function='describe_maintenance_windows',
+                                                         item_name='WindowIdentities',
+                                                         Filters=[mw_enabled_filter],
+                                                         MaxResults=100)]
+        for maint_window, patching_future in futures:
+            maint_window_info = get_maint_window_info(maint_window)
+            patching_info = patching_future.result()
+            task_info = patching_info['task_info']
+            baseline_info = patching_info['baseline_info']
+            rows.append((account_number,
+                         region,
+                         maint_window['WindowId'],
+                         maint_window_info['name'],
+                         maint_window_info['sched'],
+                         maint_window_info['time_zone'],
+                         patching_info['task_1_id'],
+                         patching_info['patch_tag'],
+                         task_info['task'],
+                         task_info['operation'],
+                         patching_info['baseline_id'],
+                         baseline_info['name'],
+                         baseline_info['operating_system'],
+                         baseline_info['filter_msrc_sev'],
+                         baseline_info['filter_class'],
+                         baseline_info['delay']))
+    return rows
 
 def parse_args():
     """Create arguments and populate variables from args.
@@ -95,20 +100,36 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('-r', '--region', type=str, default=False,
                         help='AWS region; Use "all" for all regions')
+    parser.add_argument('-f', '--format', type=str, choices=['csv', 'tsv'], default='csv',
+                        help='Output format')
     return parser.parse_args()
 
-def get_maint_window_info(ssm_client, maint_window_id):
-    """Return basic parameters of Maintenance Window."""
-    name, sched, time_zone = '', '', ''
-    maint_window = ssm_client.get_maintenance_window(WindowId=maint_window_id)
+def get_maint_window_info(maint_window):
+    """Return basic parameters of Maintenance Window.
+
+    All are included in describe_maintenance_windows results, so no further query is needed"""
     name = maint_window['Name']
     sched = maint_window['Schedule']
-    try:
-        time_zone = maint_window['ScheduleTimezone']
-    except KeyError:
-        pass    # ScheduleTimezone is not set
+    time_zone = maint_window.get('ScheduleTimezone', '')   # ScheduleTimezone may not be set
     return {'name': name, 'sched': sched, 'time_zone': time_zone}
 
+def get_patching_info(ssm_client, maint_window_id, baseline_caches):
+    """Return first Task, Patch Group and Patch Baseline details of Maintenance Window.
+
+    baseline_caches holds 'baseline_id' and 'baseline_info' dicts shared within a region"""
+    task_1_id = get_maint_window_task_1(ssm_client, maint_window_id)
+    task_info = get_task_info(ssm_client, maint_window_id, task_1_id)
+    patch_tag = get_target_patch_tag(ssm_client, maint_window_id, task_info['target_id'])
+    baseline_id = helpers.get_cached(baseline_caches['baseline_id'], patch_tag,
+                                     get_baseline_id, ssm_client, patch_tag)
+    baseline_info = helpers.get_cached(baseline_caches['baseline_info'], baseline_id,
+                                       get_baseline_info, ssm_client, baseline_id)
+    return {'task_1_id': task_1_id,
+            'task_info': task_info,
+            'patch_tag': patch_tag,
+            'baseline_id': baseline_id,
+            'baseline_info': baseline_info}
+
 def get_maint_window_task_1(ssm_client, maint_window_id):
     """Return ID of first Maintenance Window Task in Maintenance Window."""
     task_1_id = ''
@@ -129,14 +150,14 @@ def get_task_info(ssm_client, maint_window_id, task_id):
             WindowId=maint_window_id,
             WindowTaskId=task_id)
 
-        target_id = next(item for item in maint_window_task['Targets']
-                         if item['Key'] == 'WindowTargetIds')['Values'][0]
+        targets = {item['Key']: item['Values'] for item in maint_window_task['Targets']}
+        target_id = targets['WindowTargetIds'][0]
         task = maint_window_task['TaskArn']
-        try:
-            operation = (maint_window_task['TaskInvocationParameters']
-                         ['RunCommand']['Parameters']['Operation'][0])
-        except (KeyError, IndexError):
-            pass    # No 'Operation' parameter or values set for task
+        # 'Operation' parameter or values may not be set for task
+        operation = (maint_window_task.get('TaskInvocationParameters', {})
+                     .get('RunCommand', {})
+                     .get('Parameters', {})
+                     .get('Operation') or [''])[0]
     return {'target_id': target_id, 'task': task, 'operation': operation}
 
 def get_target_patch_tag(ssm_client, maint_window_id, target_id):
@@ -151,8 +172,9 @@ def get_target_patch_tag(ssm_client, maint_window_id, target_id):
         except KeyError:
             pass    # No targets
         try:
-            patch_tag = next(item for item in target_list['Targets'][0]['Targets']
-                             if item['Key'] == 'tag:Patch Group')['Values'][0]
+            targets = {item['Key']: item['Values']
+                       for item in target_list['Targets'][0]['Targets']}
+            patch_tag = targets.get('tag:Patch Group', [''])[0]
         except (KeyError, IndexError):
             pass    # No 'Patch Group' tag
     return patch_tag
@@ -172,12 +194,11 @@ def get_baseline_info(ssm_client, baseline_id):
         baseline = ssm_client.get_patch_baseline(BaselineId=baseline_id)
         name = baseline['Name']
         operating_system = baseline['OperatingSystem']
-        patch_filters = (baseline['ApprovalRules']['PatchRules']
-                         [0]['PatchFilterGroup']['PatchFilters'])
-        filter_msrc_sev = ",".join(next(item for item in patch_filters
-                                        if item['Key'] == 'MSRC_SEVERITY')['Values'])
-        filter_class = ",".join(next(item for item in patch_filters
-                                     if item['Key'] == 'CLASSIFICATION')['Values'])
+        patch_filters = {item['Key']: item['Values']
+                         for item in (baseline['ApprovalRules']['PatchRules']
+                                      [0]['PatchFilterGroup']['PatchFilters'])}
+        filter_msrc_sev = ",".join(patch_filters.get('MSRC_SEVERITY', []))
+        filter_class = ",".join(patch_filters.get('CLASSIFICATION', []))
         delay = baseline['ApprovalRules']['PatchRules'][0]['ApproveAfterDays']
     return {'name': name,
             'operating_system': operating_system,